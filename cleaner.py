@@ -1,456 +1,1142 @@
-import asyncio
-import logging
-import json
-import requests
-from typing import Optional, Any
-from datetime import datetime, timedelta
-
-# --- Configuration Loading ---
-try:
-    with open('config.json', 'r') as config_file:
-        config = json.load(config_file)
-except FileNotFoundError:
-    logging.error("config.json not found. Please create it with your API URLs and keys.")
-    exit(1)
-except json.JSONDecodeError:
-    logging.error("Error decoding config.json. Please check its format.")
-    exit(1)
-
-# Retrieve configuration values, providing default empty strings or values if not found
-SONARR_API_URL = config.get('SONARR_API_URL', '') + "/api/v3"
-SONARR_API_KEY = config.get('SONARR_API_KEY', '')
-RADARR_API_URL = config.get('RADARR_API_URL', '') + "/api/v3"
-RADARR_API_KEY = config.get('RADARR_API_KEY', '')
-API_TIMEOUT = config.get('API_TIMEOUT', 300) # Default to 300 seconds (5 minutes) for API calls and sleep
-STRIKE_COUNT = config.get('STRIKE_COUNT', 3) # Default to 3 strikes for "no connections" stalls
-
-# --- Global Dictionaries for Tracking Download States ---
-strike_counts = {} # For "stalled with no connections"
-download_progress_tracking = {} # For non-progressing download detection using 'sizeleft'
-
-# --- Constants for Non-Progressing Download Detection ---
-# These define how many checks (API_TIMEOUT intervals) a download must show no progress
-# in its 'sizeleft' before it's considered stuck and deleted.
-NO_PROGRESS_THRESHOLD_BYTES = 1024 * 1024 # 1 MB - minimum change in sizeleft to count as progress
-NO_PROGRESS_STRIKE_COUNT = 3             # Number of consecutive checks with no significant progress before deleting
-
-# --- Global variable for weekly Sonarr search ---
-# Initialize with a past timestamp to trigger search on first run
-last_sonarr_weekly_search_timestamp = 0.0 # Unix timestamp of last search
-
-# --- Logging Setup ---
-logging.basicConfig(
-    format='%(asctime)s [%(levelname)s]: %(message)s',
-    level=logging.INFO,
-    handlers=[logging.StreamHandler()]
-)
-
-# --- API Request Functions ---
-def make_api_request(url: str, api_key: str, params: Optional[dict] = None) -> Optional[Any]:
-    """
-    Makes a GET API request to the specified URL.
-
-    Args:
-        url (str): The URL for the API endpoint.
-        api_key (str): The API key for authentication.
-        params (Optional[dict]): Optional dictionary of query parameters.
-
-    Returns:
-        Optional[Any]: The JSON response from the API if successful, otherwise None.
-    """
-    headers = {
-        'X-Api-Key': api_key
-    }
-    try:
-        response = requests.get(url, headers=headers, params=params, timeout=API_TIMEOUT)
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-        return response.json()
-    except requests.exceptions.Timeout:
-        logging.error(f'API request to {url} timed out after {API_TIMEOUT} seconds.')
-        return None
-    except requests.exceptions.RequestException as e:
-        logging.error(f'Error making API request to {url}: {e}')
-        return None
-
-def make_api_delete(url: str, api_key: str, params: Optional[dict] = None) -> Optional[Any]:
-    """
-    Makes a DELETE API request to the specified URL.
-
-    Args:
-        url (str): The URL for the API endpoint.
-        api_key (str): The API key for authentication.
-        params (Optional[dict]): Optional dictionary of query parameters.
-
-    Returns:
-        Optional[Any]: The JSON response from the API if successful, otherwise None.
-    """
-    headers = {
-        'X-Api-Key': api_key
-    }
-    try:
-        response = requests.delete(url, headers=headers, params=params, timeout=API_TIMEOUT)
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-        # Some DELETE endpoints might not return JSON, so handle that gracefully
-        try:
-            return response.json()
-        except json.JSONDecodeError:
-            logging.info(f"DELETE request to {url} returned non-JSON response (Status: {response.status_code}).")
-            return {"status": "success", "message": "No JSON response from delete operation"}
-    except requests.exceptions.Timeout:
-        logging.error(f'API delete request to {url} timed out after {API_TIMEOUT} seconds.')
-        return None
-    except requests.exceptions.RequestException as e:
-        logging.error(f'Error making API delete request to {url}: {e}')
-        return None
-
-def make_api_post(url: str, api_key: str, data: Optional[dict] = None) -> Optional[Any]:
-    """
-    Makes a POST API request to the specified URL. Used for sending commands like search.
-
-    Args:
-        url (str): The URL for the API endpoint.
-        api_key (str): The API key for authentication.
-        data (Optional[dict]): Optional dictionary of data to send in the request body (JSON).
-
-    Returns:
-        Optional[Any]: The JSON response from the API if successful, otherwise None.
-    """
-    headers = {
-        'X-Api-Key': api_key,
-        'Content-Type': 'application/json'
-    }
-    try:
-        response = requests.post(url, headers=headers, json=data, timeout=API_TIMEOUT)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.Timeout:
-        logging.error(f'API POST request to {url} timed out after {API_TIMEOUT} seconds.')
-        return None
-    except requests.exceptions.RequestException as e:
-        logging.error(f'Error making API POST request to {url}: {e}')
-        return None
-
-# --- Helper Functions ---
-def count_records(api_url: str, api_key: str) -> int:
-    """
-    Counts the total number of records in a given API queue.
-
-    Args:
-        api_url (str): The base URL for the API (Sonarr/Radarr).
-        api_key (str): The API key for authentication.
-
-    Returns:
-        int: The total number of records, or 0 if the queue cannot be retrieved.
-    """
-    the_url = f'{api_url}/queue'
-    the_queue = make_api_request(the_url, api_key)
-    if the_queue is not None and isinstance(the_queue, dict) and 'totalRecords' in the_queue:
-        return the_queue['totalRecords']
-    logging.warning(f"Could not retrieve total records for {api_url}/queue. Returning 0.")
-    return 0
-
-def _delete_and_blocklist_item(item_id: int, title: str, api_url: str, api_key: str, queue_name: str, reason: str) -> bool:
-    """
-    Helper function to delete and blocklist a queue item, and clean up its tracking info.
-
-    Args:
-        item_id (int): The ID of the item to delete.
-        title (str): The title of the item for logging.
-        api_url (str): The base API URL (Sonarr/Radarr).
-        api_key (str): The API key.
-        queue_name (str): 'Sonarr' or 'Radarr'.
-        reason (str): The reason for deletion (e.g., 'failed', 'dangerous file', 'stalled').
-
-    Returns:
-        bool: True if deletion was successful, False otherwise.
-    """
-    logging.warning(f'Found {reason} download: "{title}" (ID: {item_id}). Deleting and blocklisting.')
-    delete_result = make_api_delete(
-        f'{api_url}/queue/{item_id}',
-        api_key,
-        {'removeFromClient': 'true', 'blocklist': 'true'}
-    )
-    if delete_result:
-        logging.info(f'Successfully deleted and blocklisted {queue_name} item ({reason}): {title}')
-        # Clean up tracking info for this item across all systems
-        if item_id in strike_counts:
-            del strike_counts[item_id]
-        if item_id in download_progress_tracking:
-            del download_progress_tracking[item_id]
-        return True
-    else:
-        logging.error(f'Failed to delete and blocklist {queue_name} item ({reason}): {title}')
-        return False
-
-def _trigger_search_command(item: dict, api_url: str, api_key: str, is_sonarr: bool, title: str, queue_name: str) -> None:
-    """
-    Helper function to trigger a re-search command for a series or movie.
-
-    Args:
-        item (dict): The queue item dictionary.
-        api_url (str): The base API URL (Sonarr/Radarr).
-        api_key (str): The API key.
-        is_sonarr (bool): True if Sonarr, False if Radarr.
-        title (str): The title of the item for logging.
-        queue_name (str): 'Sonarr' or 'Radarr'.
-    """
-    search_payload = {}
-    if is_sonarr:
-        series_id = item.get('seriesId')
-        if series_id:
-            search_payload = {"name": "SeriesSearch", "seriesId": series_id}
-        else:
-            logging.warning(f'Could not find SeriesId for re-search for Sonarr item: {title} (ID: {item.get("id")})')
-    else: # Radarr
-        movie_id = item.get('movieId')
-        if movie_id:
-            search_payload = {"name": "MovieSearch", "movieId": movie_id}
-        else:
-            logging.warning(f'Could not find MovieId for re-search for Radarr item: {title} (ID: {item.get("id")})')
-
-    if search_payload:
-        logging.debug(f"Attempting to trigger search with payload: {search_payload}")
-        search_result = make_api_post(f'{api_url}/command', api_key, search_payload)
-        if search_result:
-            logging.info(f'Successfully triggered re-search for {queue_name} item: {title}')
-        else:
-            logging.error(f'Failed to trigger re-search for {queue_name} item: {title}')
-    else:
-        logging.warning(f'No valid search payload generated for {queue_name} item: {title}')
-
-# --- Main Queue Processing Logic ---
-async def process_queue(api_url: str, api_key: str, is_sonarr: bool = True) -> None:
-    """
-    Processes the Sonarr or Radarr queue to identify and act on stalled,
-    dangerous, or non-progressing downloads.
-
-    Args:
-        api_url (str): The base URL for the API (Sonarr/Radarr).
-        api_key (str): The API key for authentication.
-        is_sonarr (bool): True if processing Sonarr queue, False for Radarr.
-    """
-    queue_name = "Sonarr" if is_sonarr else "Radarr"
-    logging.info(f'Checking {queue_name} queue for stalled, dangerous, and non-progressing items...')
-
-    total_records = count_records(api_url, api_key)
-    if total_records == 0:
-        logging.info(f"{queue_name} queue is empty or could not be retrieved. Skipping processing.")
-        return
-
-    queue_url = f'{api_url}/queue'
-    queue_data = make_api_request(queue_url, api_key, {'page': '1', 'pageSize': total_records})
-
-    if queue_data is None or 'records' not in queue_data or not isinstance(queue_data['records'], list):
-        logging.warning(f'{queue_name} queue data is invalid or empty. Skipping processing.')
-        return
-
-    logging.info(f'Processing {len(queue_data["records"])} items in {queue_name} queue...')
-    for item in queue_data['records']:
-        item_id = item.get('id')
-        title = item.get('title', 'Unknown Item')
-        status = item.get('status')
-        tracked_download_status = item.get('trackedDownloadStatus')
-        tracked_download_state = item.get('trackedDownloadState')
-        error_message = item.get('errorMessage')
-        status_messages = item.get("statusMessages")
-        current_sizeleft = item.get('sizeleft')
-        protocol = item.get('protocol') # Get the protocol (usenet or torrent)
-
-        # Basic validation for essential keys
-        if not all(k in item for k in ['id', 'title', 'status', 'trackedDownloadStatus', 'trackedDownloadState']):
-            logging.warning(f'Skipping item in {queue_name} queue due to missing essential keys: {item.keys()}')
-            continue
-
-        # Extract all messages from statusMessages for checking
-        all_status_messages_text = []
-        if isinstance(status_messages, list):
-            for sm_entry in status_messages:
-                # Add the 'title' of the status message entry
-                if isinstance(sm_entry, dict) and "title" in sm_entry:
-                    all_status_messages_text.append(sm_entry["title"])
-                # Add messages from the 'messages' list within the entry
-                if isinstance(sm_entry, dict) and "messages" in sm_entry and isinstance(sm_entry["messages"], list):
-                    all_status_messages_text.extend(sm_entry["messages"])
-
-        logging.info(f'Processing item: {title} (ID: {item_id}) - Status: {status}, Tracked Status: {tracked_download_status}, Tracked State: {tracked_download_state}, Error: {error_message}, Status Messages: {all_status_messages_text}, Size Left: {current_sizeleft}, Protocol: {protocol}')
-
-        # --- Handle "Failed" downloads ---
-        if status == 'failed':
-            _delete_and_blocklist_item(item_id, title, api_url, api_key, queue_name, "failed")
-            continue # Move to the next item
-
-        # --- Handle "One or more movies/episodes expected in this release were not imported or missing" ---
-        # This applies to both Sonarr and Radarr
-        is_missing_files_warning = any("not imported or missing" in msg for msg in all_status_messages_text)
-
-        if is_missing_files_warning and \
-           status == "completed" and \
-           tracked_download_status == "warning" and \
-           tracked_download_state == "importPending":
-            
-            logging.warning(f'{queue_name} item: "{title}" (ID: {item_id}) indicates missing files. Deleting and blocklisting (no re-search).')
-            _delete_and_blocklist_item(item_id, title, api_url, api_key, queue_name, "missing files")
-            continue # Move to the next item
-
-        # --- Handle "No files found are eligible for import" ---
-        is_no_eligible_files_warning = any("No files found are eligible for import" in msg for msg in all_status_messages_text)
-
-        if is_no_eligible_files_warning and \
-           status == "completed" and \
-           tracked_download_status == "warning" and \
-           tracked_download_state == "importPending":
-
-            logging.warning(f'No eligible files found for import for {queue_name} item: {title} (ID: {item_id}). Deleting, blocklisting, and re-searching.')
-
-            if _delete_and_blocklist_item(item_id, title, api_url, api_key, queue_name, "no eligible files"):
-                _trigger_search_command(item, api_url, api_key, is_sonarr, title, queue_name)
-            continue # Move to the next item
-
-        # --- Handle "Potentially dangerous file" with specific tracked status/state ---
-        is_dangerous_file_warning = any("Caution: Found potentially dangerous file" in msg for msg in all_status_messages_text)
-
-        if is_dangerous_file_warning and \
-           tracked_download_status == "warning" and \
-           tracked_download_state == "importPending":
-
-            logging.warning(f'Potentially dangerous file found for {queue_name} item: {title} (ID: {item_id}). Deleting, blocklisting, and re-searching.')
-
-            if _delete_and_blocklist_item(item_id, title, api_url, api_key, queue_name, "potentially dangerous file"):
-                _trigger_search_command(item, api_url, api_key, is_sonarr, title, queue_name)
-            continue # Move to the next item
-
-        # --- Handle general "importBlocked" warnings (applies to both Sonarr and Radarr) ---
-        # This will now cover cases where trackedDownloadState is 'importBlocked',
-        # including scenarios like "Not an upgrade" if the API reports it as 'importBlocked'.
-        if status == "completed" and \
-           tracked_download_status == "warning" and \
-           tracked_download_state == "importBlocked":
-            
-            logging.warning(f'{queue_name} item: "{title}" (ID: {item_id}) is completed with a warning and import is blocked. Deleting and blocklisting (no re-search).')
-            _delete_and_blocklist_item(item_id, title, api_url, api_key, queue_name, "import blocked")
-            continue # Move to the next item
-
-        # --- Handle "Stalled with no connections" error ---
-        if status == 'warning' and error_message == 'The download is stalled with no connections':
-            item_id = item['id']
-            if item_id not in strike_counts:
-                strike_counts[item_id] = 0
-            strike_counts[item_id] += 1
-            logging.info(f'Item "{title}" has {strike_counts[item_id]} connection stalls.')
-            if strike_counts[item_id] >= STRIKE_COUNT:
-                _delete_and_blocklist_item(item_id, title, api_url, api_key, queue_name, "stalled")
-            continue # Move to the next item
-        elif item_id in strike_counts:
-            # Item is no longer stalled by connection issues, reset its strike count
-            logging.info(f'Item "{title}" is no longer connection stalled. Resetting strike count.')
-            del strike_counts[item_id]
-
-        # --- Handle downloads stuck in "downloading" using 'sizeleft' (Only for torrents) ---
-        if status == 'downloading' and current_sizeleft is not None and protocol == 'torrent':
-            if item_id not in download_progress_tracking:
-                # First time seeing this item in 'downloading' status, initialize tracking
-                download_progress_tracking[item_id] = {
-                    'last_sizeleft': current_sizeleft,
-                    'no_progress_count': 0
-                }
-                logging.debug(f"Started tracking download progress for {title} (ID: {item_id}). Initial size left: {current_sizeleft}.")
-            else:
-                tracking_info = download_progress_tracking[item_id]
-                last_sizeleft = tracking_info['last_sizeleft']
-
-                # Check if progress has been made (current_sizeleft is significantly less than last_sizeleft)
-                if (last_sizeleft - current_sizeleft) > NO_PROGRESS_THRESHOLD_BYTES:
-                    # Progress made, reset counter and update last_sizeleft
-                    tracking_info['last_sizeleft'] = current_sizeleft
-                    tracking_info['no_progress_count'] = 0
-                    logging.debug(f"Download {title} (ID: {item_id}) is progressing. Size left: {current_sizeleft}.")
-                else:
-                    # No significant progress, increment no_progress_count
-                    tracking_info['no_progress_count'] += 1
-                    logging.warning(f'Download "{title}" (ID: {item_id}) has shown no significant progress. No progress count: {tracking_info["no_progress_count"]}. Size left: {current_sizeleft}.')
-
-                    if tracking_info['no_progress_count'] >= NO_PROGRESS_STRIKE_COUNT:
-                        _delete_and_blocklist_item(item_id, title, api_url, api_key, queue_name, "non-progressing")
-        elif item_id in download_progress_tracking:
-            # Item is no longer 'downloading', sizeleft is missing, or it's not a torrent, remove from tracking
-            logging.debug(f"Download {title} (ID: {item_id}) is no longer downloading, missing sizeleft, or is not a torrent. Removing from tracking.")
-            del download_progress_tracking[item_id]
-
-        # --- General Fallback for Completed with Warning/Error Status ---
-        # This acts as a catch-all for items that completed downloading but have
-        # a warning or error tracked status and weren't handled by more specific rules above.
-        # This is intentionally placed last among all the status checks that might lead to a 'continue'.
-        if status == "completed" and \
-           (tracked_download_status == "warning" or tracked_download_status == "error"):
-
-            logging.warning(f'{queue_name} item: "{title}" (ID: {item_id}) completed with a general warning/error and was not specifically handled. Deleting, blocklisting, and re-searching.')
-            if _delete_and_blocklist_item(item_id, title, api_url, api_key, queue_name, "general completed warning/error"):
-                _trigger_search_command(item, api_url, api_key, is_sonarr, title, queue_name)
-            continue # Move to the next item
-
-
-# --- Wrapper Functions for Queue Processing ---
-async def remove_stalled_sonarr_downloads() -> None:
-    """
-    Wrapper function to call the unified queue processing for Sonarr.
-    """
-    await process_queue(SONARR_API_URL, SONARR_API_KEY, is_sonarr=True)
-
-async def remove_stalled_radarr_downloads() -> None:
-    """
-    Wrapper function to call the unified queue processing for Radarr.
-    """
-    await process_queue(RADARR_API_URL, RADARR_API_KEY, is_sonarr=False)
-
-# --- Main Execution Loop ---
-async def main() -> None:
-    """
-    Main function to run the queue cleaner script periodically.
-    """
-    global last_sonarr_weekly_search_timestamp # Declare global to modify it
-
-    while True:
-        logging.info('Running media-tools script')
-        await remove_stalled_sonarr_downloads()
-        await remove_stalled_radarr_downloads()
-        
-        # --- Weekly Sonarr Wanted Episodes Search ---
-        current_time = datetime.now().timestamp() # Get current Unix timestamp
-        one_week_in_seconds = 7 * 24 * 60 * 60
-
-        if (current_time - last_sonarr_weekly_search_timestamp) >= one_week_in_seconds:
-            logging.info('It\'s been a week since the last Sonarr wanted episodes search. Triggering MissingEpisodeSearch command.')
-            search_command = {"name": "MissingEpisodeSearch"} 
-            search_result = make_api_post(f'{SONARR_API_URL}/command', SONARR_API_KEY, search_command)
-            if search_result:
-                logging.info('Successfully triggered Sonarr MissingEpisodeSearch for wanted episodes.')
-                last_sonarr_weekly_search_timestamp = current_time # Update timestamp
-            else:
-                logging.error('Failed to trigger Sonarr MissingEpisodeSearch. Check Sonarr logs for details.')
-
-        # Log current strike counts and download progress tracking
-        if strike_counts:
-            logging.info(f'Current connection strike counts: {strike_counts}')
-        else:
-            logging.info('No items currently have connection strikes.')
-            
-        if download_progress_tracking:
-            logging.info(f'Current non-progressing download tracking: {download_progress_tracking}')
-        else:
-            logging.info('No items currently being tracked for non-progressing downloads.')
-
-        logging.info(f'Finished running media-tools script. Sleeping for {API_TIMEOUT / 60} minutes.')
-        await asyncio.sleep(API_TIMEOUT)
-
-if __name__ == '__main__':
-    # Add a check for API keys and URLs before starting the loop
-    if not (SONARR_API_URL and SONARR_API_KEY and RADARR_API_URL and RADARR_API_KEY):
-        logging.critical("One or more API URLs or Keys are missing in config.json. Please ensure they are set.")
-        exit(1)
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        logging.info("Script terminated by user (Ctrl+C). Exiting.")
-    except Exception as e:
-        logging.critical(f"An unhandled error occurred: {e}", exc_info=True)
-        exit(1)
+import asyncio
+import itertools
+import logging
+import os
+import time
+import random
+import re
+import hashlib
+import hmac
+import math
+import aiohttp
+import orjson
+from aiohttp import web
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from operator import itemgetter
+from urllib.parse import urlsplit
+from config import ConfigError, load_config
+from typing import Optional, Any, AsyncIterator, Iterator
+
+# --- Configuration Loading ---
+try:
+    CFG = load_config()
+except ConfigError as e:
+    logging.error(e)
+    exit(1)
+
+# --- In-Process Response Cache ---
+# Maps (url, frozenset(params)) to (expiry on the monotonic clock, parsed JSON)
+response_cache = {}
+cache_generation = 0 # Bumped on every clear, so a refresh that started before it doesn't re-cache old data
+refreshing_cache_keys = set() # Keys with a stale-while-revalidate refresh already in flight
+
+# --- Global Dictionaries for Tracking Download States ---
+# Keyed by queue name first, since Sonarr and Radarr item IDs can overlap
+strike_counts = {'Sonarr': defaultdict(int), 'Radarr': defaultdict(int)} # For "stalled with no connections"
+download_progress_tracking = {'Sonarr': {}, 'Radarr': {}} # For non-progressing download detection using 'sizeleft'
+
+# --- Strike Count Persistence ---
+STATE_FLUSH_DELAY = 5 # Seconds to wait after a change before writing STATE_FILE, so bursts of changes cause one write
+state_flush_handle = None # Pending loop.call_later handle for the next write, if any
+state_write_lock = asyncio.Lock() # Keeps writes of STATE_FILE from overlapping, so the newest snapshot always lands last
+
+# --- Queue Run Coordination ---
+queue_locks = {} # One asyncio.Lock per queue name (created in main), so polls and webhook runs never overlap
+pending_webhook_runs = set() # Queue names with a webhook-triggered run already waiting for its lock
+background_tasks = set() # Strong references to webhook-triggered runs and cache refreshes until they finish
+
+# --- Poll Pacing ---
+POLL_JITTER = 0.1 # Each sleep is randomly stretched or shortened by up to 10%, so containers sharing a server drift apart
+THROTTLE_STATUSES = frozenset({429, 503}) # Responses meaning the server wants fewer requests
+MAX_POLL_BACKOFF = 4 # Most the poll interval is multiplied by while the server keeps throttling
+IDLE_POLL_STEP = 0.25 # How much each fully idle cycle stretches the poll interval, as a fraction of it (up to IDLE_POLL_FACTOR)
+throttled_hosts = set() # Hosts that answered with a throttling status since their queue was last polled
+
+# --- Constants for Non-Progressing Download Detection ---
+# These define how many checks (API_TIMEOUT intervals) a download must show no progress
+# in its 'sizeleft' before it's considered stuck and deleted.
+NO_PROGRESS_THRESHOLD_BYTES = 1024 * 1024 # 1 MB - minimum change in sizeleft to count as progress
+NO_PROGRESS_STRIKE_COUNT = 3             # Number of consecutive checks with no significant progress before deleting
+
+@dataclass(slots=True)
+class ProgressInfo:
+    """
+    Progress tracking for one downloading torrent.
+    """
+    last_sizeleft: int # Bytes left when progress was last seen
+    no_progress_count: int = 0 # Consecutive checks without significant progress
+
+# --- Stalled Download Detection ---
+# Compared with == rather than `is`: strings decoded from JSON are never interned
+STALLED_STATUS = 'warning'
+STALLED_NO_CONNECTIONS_MESSAGE = 'The download is stalled with no connections'
+
+# --- Early Exit for Idle Items ---
+# An untracked item with none of these statuses cannot match any rule after the "failed" check
+ACTIVE_STATUSES = frozenset({STALLED_STATUS, 'downloading'}) # Used by the stall and sizeleft rules
+PROBLEM_TRACKED_STATUSES = frozenset({'warning', 'error'}) # Used by IMPORT_RULES and the completed fallback
+
+# --- Queue Record Fields ---
+# Fields every record must have to be checked at all
+REQUIRED_ITEM_FIELDS = ('id', 'title', 'status', 'trackedDownloadStatus', 'trackedDownloadState')
+REQUIRED_ITEM_KEYS = frozenset(REQUIRED_ITEM_FIELDS)
+get_required_item_fields = itemgetter(*REQUIRED_ITEM_FIELDS) # All five in one C call; raises KeyError if any is missing
+
+# --- Status Message Matching ---
+MISSING_FILES_MESSAGE = "not imported or missing"
+NO_ELIGIBLE_FILES_MESSAGE = "No files found are eligible for import"
+DANGEROUS_FILE_MESSAGE = "Caution: Found potentially dangerous file"
+# One alternation finds every known message in a single scan of an item's status messages
+STATUS_MESSAGE_PATTERN = re.compile('|'.join(map(re.escape, (MISSING_FILES_MESSAGE, NO_ELIGIBLE_FILES_MESSAGE, DANGEROUS_FILE_MESSAGE))))
+
+# --- Import Problem Rules ---
+# Keyed by (trackedDownloadStatus, trackedDownloadState). Each entry lists, in priority order,
+# (status message that must be present or None, only when status is 'completed', reason, re-search, log message).
+IMPORT_RULES = {
+    ('warning', 'importPending'): (
+        # "One or more movies/episodes expected in this release were not imported or missing" (Sonarr and Radarr)
+        (MISSING_FILES_MESSAGE, True, "missing files", False,
+         '{queue_name} item: "{title}" (ID: {item_id}) indicates missing files. Deleting and blocklisting (no re-search).'),
+        (NO_ELIGIBLE_FILES_MESSAGE, True, "no eligible files", True,
+         'No eligible files found for import for {queue_name} item: {title} (ID: {item_id}). Deleting, blocklisting, and re-searching.'),
+        (DANGEROUS_FILE_MESSAGE, False, "potentially dangerous file", True,
+         'Potentially dangerous file found for {queue_name} item: {title} (ID: {item_id}). Deleting, blocklisting, and re-searching.'),
+    ),
+    # General "importBlocked" warnings (Sonarr and Radarr), including scenarios like "Not an upgrade"
+    ('warning', 'importBlocked'): (
+        (None, True, "import blocked", False,
+         '{queue_name} item: "{title}" (ID: {item_id}) is completed with a warning and import is blocked. Deleting and blocklisting (no re-search).'),
+    ),
+}
+
+# --- Unchanged Queue Detection ---
+# Per queue name, a digest of every page from the last scheduled run that took no action and left
+# nothing tracked. The rules are deterministic, so an identical page can't lead to anything this time either.
+quiet_queue_digests = {}
+
+# --- Queue Fetching ---
+# Ask the server to leave out the embedded series/episode/movie objects. The cleaner only reads top-level
+# record fields (id, title, status, trackedDownloadStatus, trackedDownloadState, errorMessage,
+# statusMessages, sizeleft, protocol, seriesId/movieId), so this just shrinks every /queue response.
+QUEUE_FILTER_PARAMS = {
+    'Sonarr': {'includeUnknownSeriesItems': 'false', 'includeSeries': 'false', 'includeEpisode': 'false'},
+    'Radarr': {'includeUnknownMovieItems': 'false', 'includeMovie': 'false'}
+}
+
+# --- Global variable for weekly Sonarr search ---
+last_sonarr_weekly_search_time = None # time.monotonic() of the last search; None until the first one
+
+# --- Logging Setup ---
+logging.basicConfig(
+    format='%(asctime)s [%(levelname)s]: %(message)s',
+    level=logging.INFO,
+    handlers=[logging.StreamHandler()]
+)
+
+# --- Tracking State Persistence Functions ---
+def load_state() -> None:
+    """
+    Restores strike counts and download progress tracking saved in STATE_FILE by a previous run, if any.
+    """
+    try:
+        with open(CFG.state_file, 'rb') as state_file:
+            state = orjson.loads(state_file.read())
+    except FileNotFoundError:
+        return
+    except (OSError, orjson.JSONDecodeError) as e:
+        logging.warning(f'Could not read {CFG.state_file}, starting with empty strike counts and progress tracking: {e}')
+        return
+    if not isinstance(state, dict):
+        logging.warning(f'{CFG.state_file} does not contain a JSON object, starting with empty strike counts and progress tracking.')
+        return
+
+    try:
+        for queue_name, counts in state.get('strikes', {}).items():
+            if queue_name in strike_counts:
+                # JSON object keys are always strings, but queue item IDs are ints
+                strike_counts[queue_name].update({int(item_id): int(count) for item_id, count in counts.items()})
+    except (TypeError, ValueError, AttributeError) as e:
+        logging.warning(f'Ignoring malformed connection strike counts in {CFG.state_file}: {e}')
+    try:
+        for queue_name, tracking in state.get('progress', {}).items():
+            if queue_name in download_progress_tracking:
+                # Coerced here, so a hand-edited value can't fail the sizeleft comparison on every run instead
+                download_progress_tracking[queue_name].update({
+                    int(item_id): ProgressInfo(int(info['last_sizeleft']), int(info.get('no_progress_count', 0)))
+                    for item_id, info in tracking.items()
+                })
+    except (TypeError, ValueError, KeyError, AttributeError) as e:
+        logging.warning(f'Ignoring malformed progress tracking in {CFG.state_file}: {e!r}')
+    logging.info(f'Restored connection strike counts from {CFG.state_file}: {format_strike_counts()}')
+    if any(download_progress_tracking.values()):
+        logging.info(f'Restored non-progressing download tracking from {CFG.state_file}: {download_progress_tracking}')
+
+def _write_state_file(data: bytes) -> None:
+    """
+    Atomically replaces STATE_FILE with the given contents. Runs in a worker thread.
+
+    Args:
+        data (bytes): The serialised state.
+    """
+    temp_path = f'{CFG.state_file}.tmp'
+    with open(temp_path, 'wb') as state_file:
+        state_file.write(data)
+    os.replace(temp_path, CFG.state_file) # Readers never see a half-written file
+
+async def flush_state() -> None:
+    """
+    Atomically writes the current strike counts and download progress tracking to STATE_FILE.
+
+    The state is serialised on the event loop, so it is a consistent snapshot, then written
+    from a worker thread so a slow disk never stalls queue processing or webhooks.
+    """
+    global state_flush_handle
+    if state_flush_handle is not None:
+        state_flush_handle.cancel()
+        state_flush_handle = None
+    async with state_write_lock:
+        # orjson writes ProgressInfo dataclasses as plain objects, the same shape load_state reads back,
+        # and OPT_NON_STR_KEYS turns the int item ids into JSON's string keys
+        data = orjson.dumps({'strikes': strike_counts, 'progress': download_progress_tracking}, option=orjson.OPT_NON_STR_KEYS)
+        try:
+            await asyncio.to_thread(_write_state_file, data)
+        except OSError as e:
+            logging.error(f'Could not write tracking state to {CFG.state_file}: {e}')
+
+def _start_state_flush() -> None:
+    """
+    Runs flush_state in the background. Called by the loop once STATE_FLUSH_DELAY has passed.
+    """
+    task = asyncio.create_task(flush_state())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+def schedule_state_flush() -> None:
+    """
+    Schedules a write of STATE_FILE in STATE_FLUSH_DELAY seconds, unless one is already pending.
+    """
+    global state_flush_handle
+    if state_flush_handle is None:
+        state_flush_handle = asyncio.get_running_loop().call_later(STATE_FLUSH_DELAY, _start_state_flush)
+
+def format_strike_counts() -> dict:
+    """
+    Returns the strike counts as plain dicts, so log lines don't show the defaultdict wrapper.
+    """
+    return {queue_name: dict(counts) for queue_name, counts in strike_counts.items()}
+
+# --- HTTP Sessions ---
+MAX_REQUESTS_PER_HOST = 10 # Connection cap per Sonarr/Radarr host, and the most the adaptive limiter allows
+DNS_CACHE_TTL = 300 # Seconds a resolved Sonarr/Radarr address is reused; these hosts rarely move
+INITIAL_REQUESTS_PER_HOST = 4 # Where the adaptive limiter starts before it has seen any responses
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit for one Sonarr/Radarr host: grows by about one request per
+    round of successful responses and halves when the server throttles or times out.
+    """
+
+    def __init__(self, initial: int = INITIAL_REQUESTS_PER_HOST, maximum: int = MAX_REQUESTS_PER_HOST):
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        """
+        Waits until another request fits under the current limit.
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, overloaded: bool) -> None:
+        """
+        Frees a request's slot and adjusts the limit from its outcome.
+
+        Args:
+            overloaded (bool): True if the request was throttled or timed out.
+        """
+        async with self._condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(1.0, self.limit / 2)
+                logging.debug(f'Server overloaded, lowering concurrent request limit to {int(self.limit)}.')
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+request_limiters = {} # One AdaptiveLimiter per host (netloc), created on first use
+
+@asynccontextmanager
+async def limited_request(url: str) -> AsyncIterator[None]:
+    """
+    Holds a slot in the target host's adaptive limiter for the duration of one request.
+
+    Args:
+        url (str): The URL being requested.
+    """
+    host = urlsplit(url).netloc
+    limiter = request_limiters.get(host)
+    if limiter is None:
+        limiter = request_limiters[host] = AdaptiveLimiter()
+    await limiter.acquire()
+    overloaded = False
+    try:
+        yield
+    except asyncio.TimeoutError:
+        overloaded = True
+        raise
+    except aiohttp.ClientResponseError as e:
+        overloaded = e.status in THROTTLE_STATUSES
+        raise
+    finally:
+        await limiter.release(overloaded)
+
+def create_session(api_key: str) -> aiohttp.ClientSession:
+    """
+    Creates a persistent HTTP session for a single Sonarr/Radarr instance.
+
+    The session keeps connections alive between requests, so each poll cycle
+    reuses the same sockets instead of opening a new connection per call.
+    Must be called from within the running event loop.
+
+    Args:
+        api_key (str): The API key sent with every request on this session.
+
+    Returns:
+        aiohttp.ClientSession: The configured session.
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=20, limit_per_host=MAX_REQUESTS_PER_HOST, keepalive_timeout=75, ttl_dns_cache=DNS_CACHE_TTL),
+        timeout=aiohttp.ClientTimeout(total=CFG.request_timeout, connect=CFG.request_connect_timeout),
+        headers={'X-Api-Key': api_key}
+    )
+
+# --- API Request Functions ---
+JSON_HEADERS = {'Content-Type': 'application/json'} # Sent with request bodies serialised by orjson
+
+def note_throttling(error: aiohttp.ClientError, url: str) -> None:
+    """
+    Remembers that the server asked us to slow down, so the next poll of its queue backs off.
+
+    Args:
+        error (aiohttp.ClientError): The error raised for a request.
+        url (str): The URL that was requested.
+    """
+    if isinstance(error, aiohttp.ClientResponseError) and error.status in THROTTLE_STATUSES:
+        throttled_hosts.add(urlsplit(url).netloc)
+
+async def make_api_request(session: aiohttp.ClientSession, url: str, params: Optional[dict] = None, cache_policy: str = 'short') -> Optional[Any]:
+    """
+    Makes a GET API request to the specified URL.
+
+    Successful responses are cached in-process for the TTL of the given cache
+    policy, so repeated identical requests within that window are served
+    without hitting Sonarr/Radarr again. For a further CFG.cache_stale_ttl
+    seconds an expired entry is still served, while a background request
+    refreshes it (stale-while-revalidate).
+
+    Args:
+        session (aiohttp.ClientSession): The session for the target Sonarr/Radarr instance.
+        url (str): The URL for the API endpoint.
+        params (Optional[dict]): Optional dictionary of query parameters.
+        cache_policy (str): Key into CFG.cache_ttls ('none', 'short', 'normal' or 'long').
+
+    Returns:
+        Optional[Any]: The JSON response from the API if successful, otherwise None.
+    """
+    ttl = CFG.cache_ttls.get(cache_policy, 0)
+    cache_key = (url, frozenset(params.items()) if params else None)
+    if ttl > 0:
+        cached = response_cache.get(cache_key)
+        now = time.monotonic()
+        if cached is not None and now < cached[0]:
+            logging.debug('Serving cached response for %s with params %s.', url, params)
+            return cached[1]
+        if cached is not None and now < cached[0] + CFG.cache_stale_ttl:
+            # Slightly stale: answer immediately and refresh in the background for the next caller
+            if cache_key not in refreshing_cache_keys:
+                refreshing_cache_keys.add(cache_key)
+                task = asyncio.create_task(_refresh_cached_response(session, url, params, ttl, cache_key))
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
+            logging.debug('Serving stale cached response for %s with params %s while it refreshes.', url, params)
+            return cached[1]
+
+    generation = cache_generation
+    result = await _fetch_json(session, url, params)
+    if result is not None and ttl > 0 and generation == cache_generation:
+        response_cache[cache_key] = (time.monotonic() + ttl, result)
+    return result
+
+async def _fetch_json(session: aiohttp.ClientSession, url: str, params: Optional[dict] = None) -> Optional[Any]:
+    """
+    Sends a GET request and parses the JSON response, bypassing the response cache.
+
+    Args:
+        session (aiohttp.ClientSession): The session for the target Sonarr/Radarr instance.
+        url (str): The URL for the API endpoint.
+        params (Optional[dict]): Optional dictionary of query parameters.
+
+    Returns:
+        Optional[Any]: The JSON response from the API if successful, otherwise None.
+    """
+    try:
+        async with limited_request(url), session.get(url, params=params) as response:
+            response.raise_for_status() # Raise ClientResponseError for bad responses (4xx or 5xx)
+            return orjson.loads(await response.read())
+    except asyncio.TimeoutError:
+        logging.error(f'API request to {url} timed out after {CFG.request_timeout} seconds.')
+        return None
+    except aiohttp.ClientError as e:
+        note_throttling(e, url)
+        logging.error(f'Error making API request to {url}: {e}')
+        return None
+    except orjson.JSONDecodeError as e:
+        logging.error(f'Error making API request to {url}: {e}')
+        return None
+
+async def _refresh_cached_response(session: aiohttp.ClientSession, url: str, params: Optional[dict], ttl: float, cache_key: tuple) -> None:
+    """
+    Re-fetches a stale cache entry in the background.
+
+    Args:
+        session (aiohttp.ClientSession): The session for the target Sonarr/Radarr instance.
+        url (str): The URL for the API endpoint.
+        params (Optional[dict]): Optional dictionary of query parameters.
+        ttl (float): Seconds the refreshed entry stays fresh.
+        cache_key (tuple): The entry's key in response_cache.
+    """
+    generation = cache_generation
+    try:
+        result = await _fetch_json(session, url, params)
+        if result is not None and generation == cache_generation:
+            response_cache[cache_key] = (time.monotonic() + ttl, result)
+    finally:
+        refreshing_cache_keys.discard(cache_key)
+
+def clear_response_cache() -> None:
+    """
+    Drops every cached GET response, including ones being refreshed right now.
+    """
+    global cache_generation
+    response_cache.clear()
+    cache_generation += 1
+
+async def make_api_delete(session: aiohttp.ClientSession, url: str, params: Optional[dict] = None, json_body: Optional[dict] = None) -> Optional[Any]:
+    """
+    Makes a DELETE API request to the specified URL.
+
+    Args:
+        session (aiohttp.ClientSession): The session for the target Sonarr/Radarr instance.
+        url (str): The URL for the API endpoint.
+        params (Optional[dict]): Optional dictionary of query parameters.
+        json_body (Optional[dict]): Optional dictionary to send as the JSON request body (used by bulk endpoints).
+
+    Returns:
+        Optional[Any]: The JSON response from the API if successful, otherwise None.
+    """
+    try:
+        body_kwargs = {'data': orjson.dumps(json_body), 'headers': JSON_HEADERS} if json_body is not None else {}
+        async with limited_request(url), session.delete(url, params=params, **body_kwargs) as response:
+            response.raise_for_status() # Raise ClientResponseError for bad responses (4xx or 5xx)
+            # The queue has changed, so cached GET responses are no longer accurate
+            clear_response_cache()
+            body = await response.read()
+            # Some DELETE endpoints might not return JSON, so handle that gracefully
+            try:
+                return orjson.loads(body)
+            except orjson.JSONDecodeError:
+                logging.info(f"DELETE request to {url} returned non-JSON response (Status: {response.status}).")
+                return {"status": "success", "message": "No JSON response from delete operation"}
+    except asyncio.TimeoutError:
+        logging.error(f'API delete request to {url} timed out after {CFG.request_timeout} seconds.')
+        return None
+    except aiohttp.ClientError as e:
+        note_throttling(e, url)
+        logging.error(f'Error making API delete request to {url}: {e}')
+        return None
+
+async def make_api_post(session: aiohttp.ClientSession, url: str, data: Optional[dict] = None) -> Optional[Any]:
+    """
+    Makes a POST API request to the specified URL. Used for sending commands like search.
+
+    Args:
+        session (aiohttp.ClientSession): The session for the target Sonarr/Radarr instance.
+        url (str): The URL for the API endpoint.
+        data (Optional[dict]): Optional dictionary of data to send in the request body (JSON).
+
+    Returns:
+        Optional[Any]: The JSON response from the API if successful, otherwise None.
+    """
+    try:
+        # Serialised with orjson like every response is parsed; the header tells Sonarr/Radarr it is JSON
+        body_kwargs = {'data': orjson.dumps(data), 'headers': JSON_HEADERS} if data is not None else {}
+        async with limited_request(url), session.post(url, **body_kwargs) as response:
+            response.raise_for_status()
+            return orjson.loads(await response.read())
+    except asyncio.TimeoutError:
+        logging.error(f'API POST request to {url} timed out after {CFG.request_timeout} seconds.')
+        return None
+    except aiohttp.ClientError as e:
+        note_throttling(e, url)
+        logging.error(f'Error making API POST request to {url}: {e}')
+        return None
+    except orjson.JSONDecodeError as e:
+        logging.error(f'Error making API POST request to {url}: {e}')
+        return None
+
+# --- Helper Functions ---
+async def iter_queue_pages(api_url: str, session: aiohttp.ClientSession, filter_params: Optional[dict] = None) -> AsyncIterator[Optional[list]]:
+    """
+    Yields the records of a given API queue one page at a time.
+
+    The queue is requested in pages of CFG.queue_page_size. 'totalRecords' from the
+    first page says how many more pages there are, and those are all requested at
+    once (the per-host limiter bounds how many run together), so a large queue
+    costs roughly one round trip more than a small one. Pages are yielded in order,
+    each as soon as it and every page before it have arrived.
+
+    Args:
+        api_url (str): The base URL for the API (Sonarr/Radarr).
+        session (aiohttp.ClientSession): The session for the Sonarr/Radarr instance.
+        filter_params (Optional[dict]): Extra query parameters sent with every page request.
+
+    Yields:
+        Optional[list]: The records of each page, or None (and then nothing more) if a page could not be retrieved.
+    """
+    queue_url = f'{api_url}/queue'
+    page_size = CFG.queue_page_size
+    extra_params = filter_params or {}
+    def request_page(page: int) -> asyncio.Task:
+        return asyncio.create_task(make_api_request(session, queue_url, {'page': page, 'pageSize': page_size, **extra_params}))
+
+    pending = [request_page(1)]
+    try:
+        for page in itertools.count(1):
+            if not pending:
+                return
+            queue_data = await pending.pop(0)
+            if not isinstance(queue_data, dict) or not isinstance(queue_data.get('records'), list):
+                logging.warning(f"Could not retrieve page {page} of {queue_url}.")
+                yield None
+                return
+
+            page_records = queue_data['records']
+            if page == 1 and len(page_records) == page_size:
+                # The rest of the pages are fetched while the first one is being checked
+                page_count = math.ceil(queue_data.get('totalRecords', 0) / page_size)
+                pending.extend(request_page(next_page) for next_page in range(2, page_count + 1))
+            if page == 1 or page_records: # A queue that shrank since page 1 can leave trailing pages empty
+                yield page_records
+    finally:
+        # The caller stopped early, so the remaining pages are not needed
+        for task in pending:
+            task.cancel()
+
+async def _delete_and_blocklist_items(pending: list, api_url: str, session: aiohttp.ClientSession, queue_name: str) -> bool:
+    """
+    Helper function to delete and blocklist queue items in one bulk request, and clean up their tracking info.
+
+    Args:
+        pending (list): (item, reason, research) tuples collected while processing the queue,
+            where reason is e.g. 'failed', 'dangerous file' or 'stalled'.
+        api_url (str): The base API URL (Sonarr/Radarr).
+        session (aiohttp.ClientSession): The session for the Sonarr/Radarr instance.
+        queue_name (str): 'Sonarr' or 'Radarr'.
+
+    Returns:
+        bool: True if deletion was successful, False otherwise.
+    """
+    for item, reason, _ in pending:
+        logging.warning(f'Found {reason} download: "{item["title"]}" (ID: {item["id"]}). Deleting and blocklisting.')
+    delete_result = await make_api_delete(
+        session,
+        f'{api_url}/queue/bulk',
+        {'removeFromClient': 'true', 'blocklist': 'true'},
+        json_body={'ids': [item['id'] for item, _, _ in pending]}
+    )
+    if delete_result:
+        for item, reason, _ in pending:
+            item_id = item['id']
+            logging.info(f'Successfully deleted and blocklisted {queue_name} item ({reason}): {item["title"]}')
+            # Clean up tracking info for this item across all systems
+            if strike_counts[queue_name].pop(item_id, None) is not None:
+                schedule_state_flush()
+            if item_id in download_progress_tracking[queue_name]:
+                del download_progress_tracking[queue_name][item_id]
+        return True
+    else:
+        for item, reason, _ in pending:
+            logging.error(f'Failed to delete and blocklist {queue_name} item ({reason}): {item["title"]}')
+        return False
+
+async def _trigger_search_commands(items: list, api_url: str, session: aiohttp.ClientSession, is_sonarr: bool, queue_name: str) -> None:
+    """
+    Helper function to trigger re-search commands for the series or movies of deleted items.
+
+    Radarr searches every movie in one MoviesSearch command. Sonarr's SeriesSearch takes a
+    single series, so one command is sent per distinct series (several episodes of the same
+    series only search it once), all at the same time.
+
+    Args:
+        items (list): The deleted queue item dictionaries to re-search.
+        api_url (str): The base API URL (Sonarr/Radarr).
+        session (aiohttp.ClientSession): The session for the Sonarr/Radarr instance.
+        is_sonarr (bool): True if Sonarr, False if Radarr.
+        queue_name (str): 'Sonarr' or 'Radarr'.
+    """
+    id_key = 'seriesId' if is_sonarr else 'movieId'
+    items_by_target = {} # seriesId/movieId -> items needing it, in first-seen order
+    for item in items:
+        target_id = item.get(id_key)
+        if target_id:
+            items_by_target.setdefault(target_id, []).append(item)
+        else:
+            logging.warning(f'Could not find {"SeriesId" if is_sonarr else "MovieId"} for re-search for {queue_name} item: {item["title"]} (ID: {item.get("id")})')
+    if not items_by_target:
+        return
+
+    command_url = f'{api_url}/command'
+    if is_sonarr:
+        search_payloads = [{"name": "SeriesSearch", "seriesId": series_id} for series_id in items_by_target]
+        search_groups = list(items_by_target.values())
+    else: # Radarr
+        search_payloads = [{"name": "MoviesSearch", "movieIds": list(items_by_target)}]
+        search_groups = [[item for target_items in items_by_target.values() for item in target_items]]
+
+    for search_payload in search_payloads:
+        logging.debug(f"Attempting to trigger search with payload: {search_payload}")
+    # One failing command doesn't stop the rest
+    results = await asyncio.gather(
+        *(make_api_post(session, command_url, search_payload) for search_payload in search_payloads),
+        return_exceptions=True
+    )
+    for group, search_result in zip(search_groups, results):
+        if isinstance(search_result, Exception):
+            logging.error(f'Error while triggering re-search for {queue_name}: {search_result}', exc_info=search_result)
+            search_result = None
+        for item in group:
+            if search_result:
+                logging.info(f'Successfully triggered re-search for {queue_name} item: {item["title"]}')
+            else:
+                logging.error(f'Failed to trigger re-search for {queue_name} item: {item["title"]}')
+
+# --- Main Queue Processing Logic ---
+def _iter_status_messages(status_messages: Any) -> Iterator[str]:
+    """
+    Yields the title and every message of each statusMessages entry, in order.
+
+    Args:
+        status_messages (Any): The record's 'statusMessages' value; anything but a list yields nothing.
+
+    Yields:
+        str: Each status message title and message.
+    """
+    if not isinstance(status_messages, list):
+        return
+    for sm_entry in status_messages:
+        if not isinstance(sm_entry, dict):
+            continue
+        # The 'title' of the status message entry, then the messages listed under it
+        if "title" in sm_entry:
+            yield sm_entry["title"]
+        messages = sm_entry.get("messages")
+        if isinstance(messages, list):
+            yield from messages
+
+def _log_item_details(item: dict, error_message: Optional[str], status_messages: Any, current_sizeleft: Any, protocol: Optional[str]) -> None:
+    """
+    Logs the DEBUG detail line for one queue record.
+
+    Args:
+        item (dict): The queue record.
+        error_message (Optional[str]): The record's 'errorMessage'.
+        status_messages (Any): The record's 'statusMessages'.
+        current_sizeleft (Any): The record's 'sizeleft'.
+        protocol (Optional[str]): The record's 'protocol'.
+    """
+    logging.debug('Processing item: %s (ID: %s) - Status: %s, Tracked Status: %s, Tracked State: %s, Error: %s, Status Messages: %s, Size Left: %s, Protocol: %s',
+                  item['title'], item['id'], item['status'], item['trackedDownloadStatus'], item['trackedDownloadState'],
+                  error_message, list(_iter_status_messages(status_messages)), current_sizeleft, protocol)
+
+def _check_item(item: dict, queue_name: str, strikes: dict, progress_tracking: dict, count_strikes: bool, log_item_details: bool) -> Optional[tuple]:
+    """
+    Applies every cleanup rule to one queue record, updating its strike count and
+    progress tracking along the way.
+
+    Args:
+        item (dict): The queue record.
+        queue_name (str): 'Sonarr' or 'Radarr'.
+        strikes (dict): Connection strike counts for this queue, by item id.
+        progress_tracking (dict): Non-progressing download tracking for this queue, by item id.
+        count_strikes (bool): Whether to advance connection strikes and progress tracking.
+        log_item_details (bool): Whether to log the per-item detail line.
+
+    Returns:
+        Optional[tuple]: (reason, research) if the item should be deleted and blocklisted, otherwise None.
+    """
+    # Basic validation for essential keys, fetched in the same step
+    try:
+        item_id, title, status, tracked_download_status, tracked_download_state = get_required_item_fields(item)
+    except KeyError:
+        # Only reached for malformed records, so the set difference costs nothing on the normal path
+        logging.warning(f'Skipping item in {queue_name} queue due to missing essential keys {sorted(REQUIRED_ITEM_KEYS - item.keys())}: {item.keys()}')
+        return None
+    error_message = item.get('errorMessage')
+    status_messages = item.get("statusMessages")
+    current_sizeleft = item.get('sizeleft')
+    protocol = item.get('protocol') # Get the protocol (usenet or torrent)
+
+    if log_item_details:
+        _log_item_details(item, error_message, status_messages, current_sizeleft, protocol)
+
+    # --- Handle "Failed" downloads ---
+    if status == 'failed':
+        return ("failed", False)
+
+    # --- Skip idle items (e.g. healthy completed ones) without running the remaining rules ---
+    if status not in ACTIVE_STATUSES and tracked_download_status not in PROBLEM_TRACKED_STATUSES \
+       and item_id not in strikes and item_id not in progress_tracking:
+        return None
+
+    # --- Import problems, looked up once by tracked status/state (see IMPORT_RULES) ---
+    import_rules = IMPORT_RULES.get((tracked_download_status, tracked_download_state))
+    if import_rules:
+        # All messages from statusMessages, joined with newlines (which none of the patterns contain,
+        # so matches never span two messages) without building an intermediate list
+        status_text = '\n'.join(_iter_status_messages(status_messages)) if status_messages else ''
+        found_messages = set(STATUS_MESSAGE_PATTERN.findall(status_text)) if status_text else set()
+        for required_message, completed_only, reason, research, log_template in import_rules:
+            if (required_message is None or required_message in found_messages) and (status == "completed" or not completed_only):
+                logging.warning(log_template.format(queue_name=queue_name, title=title, item_id=item_id))
+                return (reason, research)
+
+    # --- Handle "Stalled with no connections" error ---
+    # errorMessage is None for most records, so test it first and skip the status compare
+    if error_message == STALLED_NO_CONNECTIONS_MESSAGE and status == STALLED_STATUS:
+        if not count_strikes:
+            return None # Strikes only advance on scheduled polls
+        strikes[item_id] += 1
+        schedule_state_flush()
+        item_strikes = strikes[item_id]
+        logging.info(f'Item "{title}" has {item_strikes} connection stalls.')
+        if item_strikes >= CFG.strike_count:
+            return ("stalled", False)
+        return None # Move to the next item
+    elif item_id in strikes:
+        # Item is no longer stalled by connection issues, reset its strike count
+        logging.info(f'Item "{title}" is no longer connection stalled. Resetting strike count.')
+        del strikes[item_id]
+        schedule_state_flush()
+
+    # --- Handle downloads stuck in "downloading" using 'sizeleft' (Only for torrents) ---
+    if count_strikes and status == 'downloading' and current_sizeleft is not None and protocol == 'torrent':
+        if item_id not in progress_tracking:
+            # First time seeing this item in 'downloading' status, initialize tracking
+            progress_tracking[item_id] = ProgressInfo(current_sizeleft)
+            logging.debug("Started tracking download progress for %s (ID: %s). Initial size left: %s.", title, item_id, current_sizeleft)
+        else:
+            tracking_info = progress_tracking[item_id]
+            last_sizeleft = tracking_info.last_sizeleft
+
+            # Check if progress has been made (current_sizeleft is significantly less than last_sizeleft)
+            if (last_sizeleft - current_sizeleft) > NO_PROGRESS_THRESHOLD_BYTES:
+                # Progress made, reset counter and update last_sizeleft
+                tracking_info.last_sizeleft = current_sizeleft
+                tracking_info.no_progress_count = 0
+                logging.debug("Download %s (ID: %s) is progressing. Size left: %s.", title, item_id, current_sizeleft)
+            else:
+                # No significant progress, increment no_progress_count
+                tracking_info.no_progress_count += 1
+                logging.warning(f'Download "{title}" (ID: {item_id}) has shown no significant progress. No progress count: {tracking_info.no_progress_count}. Size left: {current_sizeleft}.')
+
+                if tracking_info.no_progress_count >= NO_PROGRESS_STRIKE_COUNT:
+                    return ("non-progressing", False)
+    elif count_strikes and item_id in progress_tracking:
+        # Item is no longer 'downloading', sizeleft is missing, or it's not a torrent, remove from tracking
+        logging.debug("Download %s (ID: %s) is no longer downloading, missing sizeleft, or is not a torrent. Removing from tracking.", title, item_id)
+        del progress_tracking[item_id]
+
+    # --- General Fallback for Completed with Warning/Error Status ---
+    # This acts as a catch-all for items that completed downloading but have
+    # a warning or error tracked status and weren't handled by more specific rules above.
+    # This is intentionally placed last among all the status checks that might lead to a deletion.
+    if status == "completed" and \
+       (tracked_download_status == "warning" or tracked_download_status == "error"):
+
+        logging.warning(f'{queue_name} item: "{title}" (ID: {item_id}) completed with a general warning/error and was not specifically handled. Deleting, blocklisting, and re-searching.')
+        return ("general completed warning/error", True)
+
+    return None
+
+async def process_queue(queue_name: str, api_url: str, session: aiohttp.ClientSession, count_strikes: bool = True) -> bool:
+    """
+    Processes the Sonarr or Radarr queue to identify and act on stalled,
+    dangerous, or non-progressing downloads.
+
+    Args:
+        queue_name (str): 'Sonarr' or 'Radarr'.
+        api_url (str): The base URL for the API (Sonarr/Radarr).
+        session (aiohttp.ClientSession): The session for the Sonarr/Radarr instance.
+        count_strikes (bool): Whether to advance connection strikes and progress tracking. Only scheduled
+            polls do, so a burst of webhook events cannot strike an item out early.
+
+    Returns:
+        bool: True if the whole queue was read and nothing in it is being deleted or tracked.
+    """
+    is_sonarr = queue_name == "Sonarr"
+    logging.debug('Checking %s queue for stalled, dangerous, and non-progressing items...', queue_name)
+
+    strikes = strike_counts[queue_name]
+    progress_tracking = download_progress_tracking[queue_name]
+    # Progress counters change on every scheduled run while anything is tracked, so such runs save them
+    save_progress = count_strikes and bool(progress_tracking)
+    current_ids = set() # Every id seen this run, for pruning once the whole queue has been read
+    to_delete = [] # (item, reason, research) for every item that should be deleted and blocklisted
+    # Checked once per cycle so the per-item detail line costs nothing unless DEBUG logging is on.
+    # Per-item DEBUG lines use %-style arguments, so their formatting is skipped too when disabled.
+    log_item_details = logging.getLogger().isEnabledFor(logging.DEBUG)
+    previous_digests = quiet_queue_digests.get(queue_name, ())
+    page_digests = []
+    # Each next page is already being fetched while the current one is checked
+    async for records in iter_queue_pages(api_url, session, QUEUE_FILTER_PARAMS.get(queue_name)):
+        if records is None:
+            # Strikes counted for earlier pages stand, but nothing is deleted or pruned from a partial queue
+            logging.warning(f'{queue_name} queue data is invalid or could not be retrieved. Skipping processing.')
+            if save_progress or progress_tracking:
+                schedule_state_flush()
+            return False
+
+        if not records and not current_ids:
+            # Nothing can still be tracked, so skip the per-id pruning and the item loop entirely
+            if strikes:
+                strikes.clear()
+                schedule_state_flush()
+            if progress_tracking:
+                progress_tracking.clear()
+                schedule_state_flush()
+            quiet_queue_digests.pop(queue_name, None)
+            logging.info(f"{queue_name} queue is empty. Skipping processing.")
+            return True
+
+        current_ids.update(item.get('id') for item in records)
+        # One C-level serialise and hash instead of running every rule on every record
+        digest = hashlib.blake2b(orjson.dumps(records), digest_size=16).digest()
+        page_index = len(page_digests)
+        page_digests.append(digest)
+        if not strikes and not progress_tracking and page_index < len(previous_digests) and previous_digests[page_index] == digest:
+            logging.info(f'{len(records)} items in {queue_name} queue are unchanged since the last check. Skipping processing.')
+            continue
+
+        logging.info(f'Processing {len(records)} items in {queue_name} queue...')
+        for item in records:
+            action = _check_item(item, queue_name, strikes, progress_tracking, count_strikes, log_item_details)
+            if action is not None:
+                to_delete.append((item, *action))
+
+    # Forget tracking for items that have left the queue (removed manually, imported, etc.),
+    # so neither dict nor STATE_FILE grows over months of uptime
+    departed_strike_ids = strikes.keys() - current_ids
+    if departed_strike_ids:
+        logging.info(f'Dropping connection strikes for {len(departed_strike_ids)} {queue_name} items no longer in the queue.')
+        for departed_id in departed_strike_ids:
+            del strikes[departed_id]
+        schedule_state_flush()
+    if save_progress or progress_tracking:
+        schedule_state_flush()
+    for departed_id in progress_tracking.keys() - current_ids:
+        logging.debug('%s item %s is no longer in the queue. Removing from progress tracking.', queue_name, departed_id)
+        del progress_tracking[departed_id]
+
+    idle = not to_delete and not strikes and not progress_tracking
+    if count_strikes:
+        if idle:
+            quiet_queue_digests[queue_name] = page_digests
+        else:
+            quiet_queue_digests.pop(queue_name, None)
+
+    # --- Delete everything found above in a single bulk request, then re-search where needed ---
+    if to_delete and await _delete_and_blocklist_items(to_delete, api_url, session, queue_name):
+        to_research = [item for item, _, research in to_delete if research]
+        if to_research:
+            try:
+                await _trigger_search_commands(to_research, api_url, session, is_sonarr, queue_name)
+            except asyncio.CancelledError:
+                # QUEUE_RUN_TIMEOUT hit after the items were already gone, so nothing will search for them again
+                titles = ', '.join(item['title'] for item in to_research)
+                logging.error(f'{queue_name} queue run was cancelled before re-searching deleted items. Search for them manually: {titles}')
+                raise
+    return idle
+
+
+# --- Queue Runs and Webhook Server ---
+WEBHOOK_TOKEN_HEADER = 'X-Webhook-Token' # Alternative to the 'token' query parameter, for clients that can send headers
+async def _process_queue_with_timeout(queue_name: str, api_url: str, session: aiohttp.ClientSession, count_strikes: bool) -> bool:
+    """
+    Runs process_queue, giving up after QUEUE_RUN_TIMEOUT seconds so one unresponsive
+    service can't hold up the cycle indefinitely.
+
+    Args:
+        queue_name (str): 'Sonarr' or 'Radarr'.
+        api_url (str): The base URL for the API (Sonarr/Radarr).
+        session (aiohttp.ClientSession): The session for the Sonarr/Radarr instance.
+        count_strikes (bool): Passed through to process_queue.
+
+    Returns:
+        bool: process_queue's result, or False if it timed out.
+    """
+    try:
+        return await asyncio.wait_for(process_queue(queue_name, api_url, session, count_strikes), CFG.queue_run_timeout)
+    except asyncio.TimeoutError:
+        logging.error(f'Processing the {queue_name} queue took longer than {CFG.queue_run_timeout} seconds. Giving up until the next run.')
+        return False
+
+async def run_process_queue(queue_name: str, api_url: str, session: aiohttp.ClientSession, count_strikes: bool = True) -> bool:
+    """
+    Runs process_queue for one service, waiting for any run of the same queue that is already in progress.
+
+    Args:
+        queue_name (str): 'Sonarr' or 'Radarr'.
+        api_url (str): The base URL for the API (Sonarr/Radarr).
+        session (aiohttp.ClientSession): The session for the Sonarr/Radarr instance.
+        count_strikes (bool): Passed through to process_queue.
+
+    Returns:
+        bool: True if the queue was idle (see process_queue).
+    """
+    async with queue_locks[queue_name]:
+        return await _process_queue_with_timeout(queue_name, api_url, session, count_strikes)
+
+async def run_process_queue_for_webhook(queue_name: str, api_url: str, session: aiohttp.ClientSession) -> None:
+    """
+    Processes a queue in response to a webhook event, coalescing bursts of events into one run.
+
+    Args:
+        queue_name (str): 'Sonarr' or 'Radarr'.
+        api_url (str): The base URL for the API (Sonarr/Radarr).
+        session (aiohttp.ClientSession): The session for the Sonarr/Radarr instance.
+    """
+    if queue_name in pending_webhook_runs:
+        return # The run already waiting for the lock will see this event's changes too
+    pending_webhook_runs.add(queue_name)
+    try:
+        async with queue_locks[queue_name]:
+            pending_webhook_runs.discard(queue_name)
+            # The event means the queue changed, so don't serve it from the response cache
+            clear_response_cache()
+            await _process_queue_with_timeout(queue_name, api_url, session, count_strikes=False)
+    except Exception as e:
+        logging.error(f'Error while processing {queue_name} queue for a webhook event: {e}', exc_info=True)
+    finally:
+        pending_webhook_runs.discard(queue_name)
+
+async def start_webhook_server(services: tuple) -> web.AppRunner:
+    """
+    Starts an HTTP listener that processes a queue whenever Sonarr/Radarr sends a webhook.
+
+    Sonarr should be pointed at /webhook/sonarr and Radarr at /webhook/radarr on WEBHOOK_HOST:WEBHOOK_PORT.
+    Every request must carry WEBHOOK_TOKEN, as a 'token' query parameter or a WEBHOOK_TOKEN_HEADER header;
+    anything else is rejected before it can trigger a queue run.
+
+    Args:
+        services (tuple): (queue_name, api_url, session) for every service.
+
+    Returns:
+        web.AppRunner: The running server, to be cleaned up on exit.
+    """
+    services_by_path = {queue_name.lower(): (queue_name, api_url, session) for queue_name, api_url, session in services}
+    expected_token = CFG.webhook_token.encode()
+
+    async def handle_webhook(request: web.Request) -> web.Response:
+        token = request.query.get('token') or request.headers.get(WEBHOOK_TOKEN_HEADER, '')
+        if not hmac.compare_digest(token.encode(), expected_token): # Constant time, so the token can't be guessed byte by byte
+            logging.warning(f'Rejected webhook request from {request.remote} with a missing or wrong token.')
+            raise web.HTTPUnauthorized()
+        service = services_by_path.get(request.match_info['service'])
+        if service is None:
+            raise web.HTTPNotFound()
+        queue_name, api_url, session = service
+        try:
+            payload = orjson.loads(await request.read())
+        except orjson.JSONDecodeError:
+            payload = None
+        event_type = payload.get('eventType', 'Unknown') if isinstance(payload, dict) else 'Unknown'
+        logging.info(f'Received {queue_name} webhook event: {event_type}')
+
+        # 'Test' is sent when the connection is saved in Sonarr/Radarr and needs no processing
+        if event_type != 'Test':
+            # Respond straight away so Sonarr/Radarr aren't kept waiting on the queue run
+            task = asyncio.create_task(run_process_queue_for_webhook(queue_name, api_url, session))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+        return web.Response(text='OK')
+
+    app = web.Application()
+    app.router.add_post('/webhook/{service}', handle_webhook)
+    runner = web.AppRunner(app, access_log=None) # Each event is already logged above
+    await runner.setup()
+    await web.TCPSite(runner, CFG.webhook_host, CFG.webhook_port).start()
+    logging.info(f'Listening for Sonarr/Radarr webhooks on {CFG.webhook_host}:{CFG.webhook_port}.')
+    return runner
+
+# --- Main Execution Loop ---
+async def run_weekly_sonarr_search(sonarr_session: aiohttp.ClientSession, retry_interval: float) -> None:
+    """
+    Triggers Sonarr's MissingEpisodeSearch once a week, on its own schedule instead of the poll's.
+
+    Args:
+        sonarr_session (aiohttp.ClientSession): The Sonarr session.
+        retry_interval (float): Seconds to wait before trying again after a failed trigger.
+    """
+    global last_sonarr_weekly_search_time # Declare global to modify it
+    one_week_in_seconds = 7 * 24 * 60 * 60
+
+    while True:
+        # Monotonic, so clock adjustments can't make the search fire early or late
+        current_time = time.monotonic()
+        if last_sonarr_weekly_search_time is not None:
+            due_in = last_sonarr_weekly_search_time + one_week_in_seconds - current_time
+        else:
+            due_in = 0 # Search once at startup
+        if due_in > 0:
+            await asyncio.sleep(due_in)
+            continue
+
+        logging.info('It\'s been a week since the last Sonarr wanted episodes search. Triggering MissingEpisodeSearch command.')
+        search_command = {"name": "MissingEpisodeSearch"}
+        search_result = await make_api_post(sonarr_session, f'{CFG.sonarr_api_url}/command', search_command)
+        if search_result:
+            logging.info('Successfully triggered Sonarr MissingEpisodeSearch for wanted episodes.')
+            last_sonarr_weekly_search_time = current_time # Update timestamp
+        else:
+            logging.error('Failed to trigger Sonarr MissingEpisodeSearch. Check Sonarr logs for details.')
+            await asyncio.sleep(retry_interval)
+
+async def poll_queue(queue_name: str, api_url: str, session: aiohttp.ClientSession, poll_interval: float) -> None:
+    """
+    Polls one queue every poll_interval seconds, on its own schedule, so a slow service never
+    delays the other one's checks.
+
+    Polls are scheduled against a monotonic deadline measured from the start of each cycle, so
+    the time spent processing doesn't push later polls back. Intervals are jittered by POLL_JITTER.
+    If the server answered with a throttling status during a cycle, the interval doubles (up to
+    MAX_POLL_BACKOFF times poll_interval); each clean cycle halves it again until it is back to
+    poll_interval. While the queue comes back idle, the interval also grows by IDLE_POLL_STEP
+    per cycle up to IDLE_POLL_FACTOR times poll_interval, and drops straight back once anything
+    needs attention. It never shrinks below poll_interval, since strikes count scheduled polls.
+
+    Args:
+        queue_name (str): 'Sonarr' or 'Radarr'.
+        api_url (str): The base URL for the API (Sonarr/Radarr).
+        session (aiohttp.ClientSession): The session for the Sonarr/Radarr instance.
+        poll_interval (float): Seconds between the starts of consecutive polls.
+    """
+    host = urlsplit(api_url).netloc
+    backoff = 1 # Multiplier applied to poll_interval
+    idle_stretch = 1.0 # Multiplier applied to poll_interval while the queue stays idle
+
+    while True:
+        cycle_start = time.monotonic()
+        logging.info(f'Running media-tools script for the {queue_name} queue')
+        try:
+            idle = await run_process_queue(queue_name, api_url, session)
+        except Exception as e:
+            logging.error(f'Error while processing {queue_name} queue: {e}', exc_info=True)
+            idle = False
+
+        # Log current strike counts and download progress tracking
+        if strike_counts[queue_name]:
+            logging.info(f'Current {queue_name} connection strike counts: {dict(strike_counts[queue_name])}')
+        else:
+            logging.info(f'No {queue_name} items currently have connection strikes.')
+
+        if download_progress_tracking[queue_name]:
+            logging.info(f'Current {queue_name} non-progressing download tracking: {download_progress_tracking[queue_name]}')
+        else:
+            logging.info(f'No {queue_name} items currently being tracked for non-progressing downloads.')
+
+        if host in throttled_hosts:
+            throttled_hosts.discard(host)
+            backoff = min(backoff * 2, MAX_POLL_BACKOFF)
+            logging.warning(f'{queue_name} asked for fewer requests. Backing off to {backoff}x the poll interval.')
+        else:
+            backoff = max(backoff // 2, 1)
+
+        if idle:
+            idle_stretch = min(idle_stretch + IDLE_POLL_STEP, CFG.idle_poll_factor)
+        else:
+            idle_stretch = 1.0
+
+        # Throttling and idleness both slow polling down; whichever asks for the longer wait wins
+        next_deadline = cycle_start + poll_interval * max(backoff, idle_stretch) * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+        sleep_seconds = max(0.0, next_deadline - time.monotonic())
+        logging.info(f'Finished running media-tools script for the {queue_name} queue. Sleeping for {sleep_seconds / 60:.1f} minutes.')
+        await asyncio.sleep(sleep_seconds)
+
+async def poll_queues(services: tuple, sonarr_session: aiohttp.ClientSession, poll_interval: float) -> None:
+    """
+    Polls every queue in its own task (see poll_queue), with the weekly Sonarr search running alongside.
+
+    Args:
+        services (tuple): (queue_name, api_url, session) for every service.
+        sonarr_session (aiohttp.ClientSession): The Sonarr session, used for the weekly search.
+        poll_interval (float): Seconds between the starts of consecutive polls of each queue.
+    """
+    weekly_search_task = asyncio.create_task(run_weekly_sonarr_search(sonarr_session, poll_interval))
+    poll_tasks = [
+        asyncio.create_task(poll_queue(queue_name, api_url, session, poll_interval))
+        for queue_name, api_url, session in services
+    ]
+    try:
+        await asyncio.gather(*poll_tasks)
+    finally:
+        weekly_search_task.cancel()
+        for poll_task in poll_tasks:
+            poll_task.cancel()
+        # Wait for them to actually stop, so main() never closes a session under a request in flight
+        weekly_result, *_ = await asyncio.gather(weekly_search_task, *poll_tasks, return_exceptions=True)
+        # Poll task errors already propagate from the gather above; the weekly search's would go unseen
+        if isinstance(weekly_result, Exception):
+            logging.error(f'Weekly Sonarr search task failed: {weekly_result}', exc_info=weekly_result)
+
+async def main() -> None:
+    """
+    Main function to run the queue cleaner script periodically.
+    """
+    load_state()
+    try:
+        # One keep-alive session per service; both are closed when the loop exits
+        async with create_session(CFG.sonarr_api_key) as sonarr_session, \
+                   create_session(CFG.radarr_api_key) as radarr_session:
+            services = (
+                ('Sonarr', CFG.sonarr_api_url, sonarr_session),
+                ('Radarr', CFG.radarr_api_url, radarr_session)
+            )
+            queue_locks.update({queue_name: asyncio.Lock() for queue_name, _, _ in services})
+
+            # With webhooks, most runs are event-driven and polling is only a safety net
+            # for stalled items that never emit an event
+            webhook_runner = await start_webhook_server(services) if CFG.webhook_port else None
+            poll_interval = CFG.webhook_poll_interval if webhook_runner else CFG.api_timeout
+            try:
+                await poll_queues(services, sonarr_session, poll_interval)
+            finally:
+                if webhook_runner is not None:
+                    await webhook_runner.cleanup()
+    finally:
+        # Write out any changes that were still waiting for the debounced flush, or finish a write in progress
+        if state_flush_handle is not None or state_write_lock.locked():
+            await flush_state()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logging.info("Script terminated by user (Ctrl+C). Exiting.")
+    except Exception as e:
+        logging.critical(f"An unhandled error occurred: {e}", exc_info=True)
+        exit(1)
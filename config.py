@@ -0,0 +1,194 @@
+"""
+Settings for the queue cleaner, read once from config.json and the environment.
+
+Every setting can be given either as a key in config.json or as an environment
+variable of the same name (e.g. STRIKE_COUNT=5). Environment variables win, so a
+container can override single values without rebuilding its config file.
+"""
+import math
+import os
+import orjson
+from dataclasses import dataclass
+from typing import Optional
+
+CONFIG_FILE = 'config.json'
+# Default QUEUE_RUN_TIMEOUT, in multiples of REQUEST_TIMEOUT: the first page, the remaining pages,
+# the bulk delete and the re-search commands may each take a full request timeout
+QUEUE_RUN_REQUEST_TIMEOUTS = 4
+
+# Every key read from config.json or the environment
+CONFIG_KEYS = (
+    'SONARR_API_URL', 'SONARR_API_KEY', 'RADARR_API_URL', 'RADARR_API_KEY',
+    'API_TIMEOUT', 'REQUEST_TIMEOUT', 'REQUEST_CONNECT_TIMEOUT', 'QUEUE_RUN_TIMEOUT',
+    'STRIKE_COUNT', 'STATE_FILE', 'CACHE_TTLS', 'CACHE_STALE_TTL', 'QUEUE_PAGE_SIZE',
+    'WEBHOOK_HOST', 'WEBHOOK_PORT', 'WEBHOOK_TOKEN', 'WEBHOOK_POLL_INTERVAL', 'IDLE_POLL_FACTOR'
+)
+REQUIRED_KEYS = ('SONARR_API_URL', 'SONARR_API_KEY', 'RADARR_API_URL', 'RADARR_API_KEY')
+
+class ConfigError(ValueError):
+    """
+    Raised when the settings are missing, malformed or of the wrong type.
+    """
+
+def _number(raw: dict, key: str, default: float, cast: type = float, name: Optional[str] = None) -> float:
+    """
+    Reads a numeric setting, accepting numbers from JSON and numeric strings from the environment.
+
+    Args:
+        raw (dict): The merged settings.
+        key (str): The setting name.
+        default (float): The value used when the setting is absent.
+        cast (type): int or float.
+        name (Optional[str]): How the setting is named in errors, if not just key.
+
+    Returns:
+        float: The setting's value.
+    """
+    value = raw.get(key, default)
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        raise ConfigError(f'{name or key} must be a number, got {value!r}.') from None
+
+def _duration(raw: dict, key: str, default: float, allow_zero: bool = False, name: Optional[str] = None) -> float:
+    """
+    Reads a setting measured in seconds, rejecting values that would make a timeout fire at once
+    or a loop spin (zero unless allow_zero, negative, NaN or infinite).
+
+    Args:
+        raw (dict): The merged settings.
+        key (str): The setting name.
+        default (float): The value used when the setting is absent.
+        allow_zero (bool): Whether 0 is meaningful, e.g. to turn a cache off.
+        name (Optional[str]): How the setting is named in errors, if not just key.
+
+    Returns:
+        float: The setting's value.
+    """
+    value = _number(raw, key, default, name=name)
+    # NaN fails every comparison, so it would slip past a plain range check
+    if not math.isfinite(value) or value < 0 or (value == 0 and not allow_zero):
+        bound = 'at least 0' if allow_zero else 'greater than 0'
+        raise ConfigError(f'{name or key} must be a finite number {bound}, got {raw.get(key)!r}.')
+    return value
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """
+    Typed, read-only settings, validated once at startup.
+    """
+    sonarr_api_url: str
+    sonarr_api_key: str
+    radarr_api_url: str
+    radarr_api_key: str
+    api_timeout: float # Seconds between queue checks
+    request_timeout: float # Seconds allowed for a single API call
+    request_connect_timeout: float # Seconds allowed to establish a connection
+    queue_run_timeout: float # Seconds allowed for processing one whole queue
+    strike_count: int # Strikes for "no connections" stalls before deleting
+    state_file: str # Where strike counts and progress tracking are persisted between restarts
+    cache_ttls: dict # Seconds a cached GET response stays fresh, per cache policy
+    cache_stale_ttl: float # Seconds past expiry a cached response is still served while it refreshes
+    queue_page_size: int # Records requested per /queue page
+    webhook_host: str
+    webhook_port: Optional[int] # None means no webhook listener (poll every api_timeout seconds)
+    webhook_token: Optional[str] # Shared secret every webhook request must carry; required with webhook_port
+    webhook_poll_interval: float # Seconds between safety polls when webhooks are enabled
+    idle_poll_factor: float # Most the poll interval stretches to (as a multiple) while both queues stay idle
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> 'Config':
+        """
+        Builds the settings from the merged config.json and environment values, providing
+        defaults for anything optional that is not set.
+
+        Args:
+            raw (dict): The merged settings, keyed by their uppercase names.
+
+        Returns:
+            Config: The validated settings.
+
+        Raises:
+            ConfigError: If a required setting is missing or a value has the wrong type.
+        """
+        missing = [key for key in REQUIRED_KEYS if not raw.get(key)]
+        if missing:
+            raise ConfigError(f'Missing {", ".join(missing)}. Please set them in {CONFIG_FILE} or the environment.')
+
+        cache_ttls = raw.get('CACHE_TTLS', {})
+        if isinstance(cache_ttls, str): # From the environment, as a JSON object
+            try:
+                cache_ttls = orjson.loads(cache_ttls)
+            except orjson.JSONDecodeError:
+                raise ConfigError(f'CACHE_TTLS must be a JSON object, got {cache_ttls!r}.') from None
+        if not isinstance(cache_ttls, dict):
+            raise ConfigError(f'CACHE_TTLS must be a JSON object, got {cache_ttls!r}.')
+        # Each bucket is compared with 0 on every request, so a string here would break every API call
+        cache_ttls = {bucket: _duration(cache_ttls, bucket, 0, allow_zero=True, name=f'CACHE_TTLS["{bucket}"]') for bucket in cache_ttls}
+
+        request_timeout = _duration(raw, 'REQUEST_TIMEOUT', 30)
+        queue_run_timeout = _duration(raw, 'QUEUE_RUN_TIMEOUT', QUEUE_RUN_REQUEST_TIMEOUTS * request_timeout)
+        if queue_run_timeout <= request_timeout:
+            # Otherwise one slow request uses up the whole run, which can be cut off between deleting items and re-searching them
+            raise ConfigError(f'QUEUE_RUN_TIMEOUT ({queue_run_timeout:g}) must be longer than REQUEST_TIMEOUT ({request_timeout:g}).')
+
+        if _number(raw, 'STRIKE_COUNT', 3, int) < 1:
+            raise ConfigError(f'STRIKE_COUNT must be at least 1, got {raw["STRIKE_COUNT"]!r}.')
+        if _number(raw, 'QUEUE_PAGE_SIZE', 200, int) < 1:
+            raise ConfigError(f'QUEUE_PAGE_SIZE must be at least 1, got {raw["QUEUE_PAGE_SIZE"]!r}.')
+        if not _number(raw, 'IDLE_POLL_FACTOR', 2) >= 1: # Written this way round so NaN is rejected too
+            raise ConfigError(f'IDLE_POLL_FACTOR must be at least 1, got {raw["IDLE_POLL_FACTOR"]!r}.')
+
+        webhook_port = raw.get('WEBHOOK_PORT')
+        webhook_token = raw.get('WEBHOOK_TOKEN') or None
+        if webhook_port not in (None, '') and webhook_token is None:
+            # The listener binds to every interface by default, so without a secret anyone could trigger queue runs
+            raise ConfigError('WEBHOOK_TOKEN must be set when WEBHOOK_PORT is, so only Sonarr/Radarr can trigger queue runs.')
+        return cls(
+            sonarr_api_url=str(raw['SONARR_API_URL']) + "/api/v3",
+            sonarr_api_key=str(raw['SONARR_API_KEY']),
+            radarr_api_url=str(raw['RADARR_API_URL']) + "/api/v3",
+            radarr_api_key=str(raw['RADARR_API_KEY']),
+            api_timeout=_duration(raw, 'API_TIMEOUT', 300), # Default to 300 seconds (5 minutes)
+            request_timeout=request_timeout,
+            request_connect_timeout=_duration(raw, 'REQUEST_CONNECT_TIMEOUT', 5),
+            queue_run_timeout=queue_run_timeout,
+            strike_count=_number(raw, 'STRIKE_COUNT', 3, int),
+            state_file=str(raw.get('STATE_FILE', 'state.json')),
+            # Individual buckets can be overridden
+            cache_ttls={'none': 0, 'short': 5, 'normal': 30, 'long': 300, **cache_ttls},
+            cache_stale_ttl=_duration(raw, 'CACHE_STALE_TTL', 0, allow_zero=True), # Off by default: stale queues could act on recovered items
+            queue_page_size=_number(raw, 'QUEUE_PAGE_SIZE', 200, int),
+            webhook_host=str(raw.get('WEBHOOK_HOST', '0.0.0.0')),
+            webhook_port=_number(raw, 'WEBHOOK_PORT', 0, int) if webhook_port not in (None, '') else None,
+            webhook_token=str(webhook_token) if webhook_token is not None else None,
+            webhook_poll_interval=_duration(raw, 'WEBHOOK_POLL_INTERVAL', 3600), # Default to a 1 hour safety poll
+            idle_poll_factor=_number(raw, 'IDLE_POLL_FACTOR', 2)
+        )
+
+def load_config(path: str = CONFIG_FILE) -> Config:
+    """
+    Reads config.json (if present), applies environment overrides and validates the result.
+
+    Args:
+        path (str): The JSON config file to read.
+
+    Returns:
+        Config: The validated settings.
+
+    Raises:
+        ConfigError: If the file cannot be parsed or the settings are invalid.
+    """
+    raw = {}
+    try:
+        with open(path, 'rb') as config_file: # orjson parses the bytes directly, with no text decode pass
+            raw = orjson.loads(config_file.read())
+    except FileNotFoundError:
+        pass # Everything may come from the environment instead; missing keys are reported below
+    except orjson.JSONDecodeError:
+        raise ConfigError(f'Error decoding {path}. Please check its format.') from None
+    if not isinstance(raw, dict):
+        raise ConfigError(f'{path} must contain a JSON object.')
+
+    raw.update({key: os.environ[key] for key in CONFIG_KEYS if key in os.environ})
+    return Config.from_dict(raw)